@@ -5,8 +5,14 @@ setup(
     version='0.1',
     packages=find_packages(),
     install_requires=[
-        'pandas>=1.0.0'
+        'pandas>=1.0.0',
+        'tqdm'
     ],
+    extras_require={
+        'isal': ['isal'],
+        'zlib-ng': ['zlib-ng'],
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'things-datasets=things_datasets.cli:main',
@@ -1,3 +1,5 @@
+import io
+import re
 import subprocess
 import tempfile
 import os
@@ -15,3 +17,221 @@ def test_main():
 
         assert result.returncode == 0
         assert 'All selected datasets are packaged into' in result.stdout
+
+def test_zip_all_folders():
+    from things_datasets.cli import zip_all_folders
+    import zipfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_dir = os.path.join(temp_dir, 'extracted')
+        os.makedirs(os.path.join(source_dir, 'sub'))
+        with open(os.path.join(source_dir, 'README.txt'), 'w') as f:
+            f.write('readme\n' * 100)
+        with open(os.path.join(source_dir, 'sub', 'data.bin'), 'wb') as f:
+            f.write(os.urandom(4096))
+
+        output_zip = os.path.join(temp_dir, 'things-datasets.zip')
+        zip_all_folders(source_dir, output_zip)
+
+        with zipfile.ZipFile(output_zip) as zipf:
+            assert zipf.testzip() is None
+            assert sorted(zipf.namelist()) == ['README.txt', 'sub/data.bin']
+            assert zipf.read('README.txt') == b'readme\n' * 100
+
+def test_deduplicate_across_datasets():
+    from things_datasets.cli import add_folder_to_zip, transplant_zip
+    import stat
+    import zipfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, 'first', 'sub'))
+        with open(os.path.join(temp_dir, 'first', 'sub', 'data.txt'), 'w') as f:
+            f.write('same\n' * 100)
+        open(os.path.join(temp_dir, 'first', 'empty.txt'), 'w').close()
+        download_zip = os.path.join(temp_dir, 'download.zip')
+        with zipfile.ZipFile(download_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('top/sub/data.txt', 'same\n' * 100)
+            zipf.writestr('top/empty.txt', '')
+
+        output_zip = os.path.join(temp_dir, 'things-datasets.zip')
+        seen_members = {}
+        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            add_folder_to_zip(zipf, os.path.join(temp_dir, 'first'), 'first', seen_members)
+            transplant_zip(download_zip, zipf, 'second', seen_members)
+
+        with zipfile.ZipFile(output_zip) as zipf:
+            assert zipf.read('first/sub/data.txt') == b'same\n' * 100
+            link = zipf.getinfo('second/sub/data.txt')
+            assert stat.S_ISLNK(link.external_attr >> 16)
+            assert zipf.read(link) == b'../../first/sub/data.txt'
+            assert not stat.S_ISLNK(zipf.getinfo('second/empty.txt').external_attr >> 16)
+
+def test_transplant_zip():
+    from things_datasets.cli import transplant_zip
+    import zipfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        download_zip = os.path.join(temp_dir, 'download.zip')
+        with zipfile.ZipFile(download_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('original_name/', '')
+            zipf.writestr('original_name/sub/data.tsv', 'a\tb\n' * 100)
+
+        output_zip = os.path.join(temp_dir, 'things-datasets.zip')
+        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            transplant_zip(download_zip, zipf, 'THINGS-fMRI1_Brainmasks')
+
+        with zipfile.ZipFile(output_zip) as zipf:
+            assert zipf.testzip() is None
+            assert zipf.namelist() == ['THINGS-fMRI1_Brainmasks/sub/data.tsv']
+            assert zipf.read('THINGS-fMRI1_Brainmasks/sub/data.tsv') == b'a\tb\n' * 100
+
+def test_transplant_zip_without_single_top_level_folder():
+    from things_datasets.cli import transplant_zip
+    import zipfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        download_zip = os.path.join(temp_dir, 'download.zip')
+        with zipfile.ZipFile(download_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('sub-01/anat.nii.gz', b'anat')
+            zipf.writestr('participants.tsv', 'participant_id\n')
+
+        output_zip = os.path.join(temp_dir, 'things-datasets.zip')
+        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            transplant_zip(download_zip, zipf, 'THINGS-MEG1_BIDS_raw_dataset')
+
+        with zipfile.ZipFile(output_zip) as zipf:
+            assert sorted(zipf.namelist()) == [
+                'THINGS-MEG1_BIDS_raw_dataset/participants.tsv',
+                'THINGS-MEG1_BIDS_raw_dataset/sub-01/anat.nii.gz',
+            ]
+
+def test_compile_include_patterns():
+    from things_datasets.cli import compile_include_patterns
+
+    include = compile_include_patterns(['sub-01/eeg/sub-01_task-rsvp_eeg.json', 'sub-02'])
+    assert include.match('sub-01/eeg/sub-01_task-rsvp_eeg.json')
+    assert include.match('sub-02/eeg/sub-02_task-rsvp_eeg.json')
+    assert not include.match('sub-01/eeg/sub-01_task-rsvp_eeg.eeg')
+    assert not include.match('sub-03/eeg/sub-03_task-rsvp_eeg.json')
+    assert compile_include_patterns([]) is None
+
+def test_download_dataset_openneuro_keeps_bids_files(monkeypatch):
+    from things_datasets import cli
+
+    paths = ['dataset_description.json', 'README', '.bidsignore', '.datalad/config',
+             'sub-01/eeg/sub-01_task-rsvp_eeg.json', 'sub-02/eeg/sub-02_task-rsvp_eeg.json']
+    monkeypatch.setattr(cli, 'list_openneuro_files', lambda dataset_id, connections: ((path, 0) for path in paths))
+    monkeypatch.setattr(cli, 'download_file', lambda url, output_path, size, connections: open(output_path, 'w').close())
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        files = cli.download_dataset_openneuro('ds000001', ['sub-01'], temp_dir)
+        assert sorted(path for _, path in files) == [
+            '.bidsignore', 'README', 'dataset_description.json', 'sub-01/eeg/sub-01_task-rsvp_eeg.json'
+        ]
+        files = cli.download_dataset_openneuro('ds000001', [''], temp_dir)
+        assert '.datalad/config' not in [path for _, path in files]
+        assert '.bidsignore' in [path for _, path in files]
+
+class FakeResponse:
+    def __init__(self, url, body, status_code=200, headers=None):
+        self.url = url
+        self.raw = io.BytesIO(body)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+def test_download_file_in_ranges(monkeypatch):
+    from things_datasets import cli
+
+    data = os.urandom(1 << 20)
+    requested = []
+
+    def fake_get(url, headers=None, **kwargs):
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', (headers or {}).get('Range', ''))
+        requested.append(match.groups() if match else None)
+        # The last range is answered with the whole file, as by a server without range support
+        if match is None or int(match.group(2)) == len(data) - 1:
+            return FakeResponse(url, data)
+        start, end = map(int, match.groups())
+        return FakeResponse(url, data[start:end + 1], 206, {'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+
+    monkeypatch.setattr(cli.requests, 'get', fake_get)
+    monkeypatch.setattr(cli, 'RANGED_DOWNLOAD_THRESHOLD', 1 << 16)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, 'download.bin')
+        cli.download_file('https://example.com/file', output_path)
+        with open(output_path, 'rb') as f:
+            assert f.read() == data
+    # Probe, one request per range, then a single stream after the last range came back whole
+    assert requested[0] == ('0', '0')
+    assert len(requested) == 2 + cli.RANGE_PARTS
+    assert requested[-1] is None
+
+def test_download_file_without_total_size(monkeypatch):
+    from things_datasets import cli
+
+    data = os.urandom(1 << 16)
+
+    def fake_get(url, headers=None, **kwargs):
+        if 'Range' in (headers or {}):
+            return FakeResponse(url, data[:1], 206, {'Content-Range': 'bytes 0-0/*'})
+        return FakeResponse(url, data)
+
+    monkeypatch.setattr(cli.requests, 'get', fake_get)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, 'download.bin')
+        cli.download_file('https://example.com/file', output_path)
+        with open(output_path, 'rb') as f:
+            assert f.read() == data
+
+def test_list_openneuro_files_follows_continuation_token(monkeypatch):
+    from things_datasets import cli
+
+    pages = {
+        None: ('<IsTruncated>true</IsTruncated><NextContinuationToken>page2</NextContinuationToken>'
+               '<Contents><Key>ds000001/README</Key><Size>10</Size></Contents>'
+               '<Contents><Key>ds000001/sub-01/</Key><Size>0</Size></Contents>'),
+        'page2': ('<IsTruncated>false</IsTruncated>'
+                  '<Contents><Key>ds000001/sub-01/eeg.json</Key><Size>2</Size></Contents>'),
+    }
+
+    def fake_get(url, params=None, **kwargs):
+        listing = pages[params.get('continuation-token')]
+        body = f'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">{listing}</ListBucketResult>'
+        response = FakeResponse(url, b'')
+        response.content = body.encode()
+        return response
+
+    monkeypatch.setattr(cli.requests, 'get', fake_get)
+    assert list(cli.list_openneuro_files('ds000001')) == [('README', 10), ('sub-01/eeg.json', 2)]
+
+def test_tar_zst_round_trip():
+    import pytest
+    zstandard = pytest.importorskip('zstandard')
+    from things_datasets.cli import add_zip_to_tar, open_archive
+    import tarfile
+    import zipfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        download_zip = os.path.join(temp_dir, 'download.zip')
+        with zipfile.ZipFile(download_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('top/sub/data.txt', 'data\n' * 100)
+
+        archive_path = os.path.join(temp_dir, 'things-datasets.tar.zst')
+        with open_archive(archive_path, 'tar.zst', zipfile.ZIP_STORED, None) as tar:
+            add_zip_to_tar(download_zip, tar, 'Dataset')
+
+        with open(archive_path, 'rb') as f, \
+                zstandard.ZstdDecompressor().stream_reader(f) as stream, \
+                tarfile.open(fileobj=stream, mode='r|') as tar:
+            member = tar.next()
+            assert member.name == 'Dataset/sub/data.txt'
+            assert tar.extractfile(member).read() == b'data\n' * 100
@@ -1,102 +1,193 @@
-import csv
+import io
+import mmap
+import multiprocessing
 import zipfile
+import zlib
 import shutil
 import os
+import posixpath
+import stat
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import pandas as pd
 import requests
 from pathlib import Path
 import argparse
-import subprocess
+import fnmatch
+import hashlib
+import logging
+import re
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+from tqdm import tqdm
+from urllib.parse import quote
+from xml.etree import ElementTree
+
+try:
+    # ISA-L's DEFLATE is several times faster than zlib and produces standard streams
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# CRC32 of every member dominates once compression is cheap; prefer the carry-less
+# multiply (PCLMULQDQ/PMULL) implementations of ISA-L or zlib-ng over stock zlib
+if isal_zlib is not None:
+    crc32 = isal_zlib.crc32
+else:
+    try:
+        from zlib_ng.zlib_ng import crc32
+    except ImportError:
+        crc32 = zlib.crc32
+
+logger = logging.getLogger(__name__)
+
+# Set on the way out (Ctrl-C, failed archive), so running downloads stop at their next chunk
+# instead of the executor waiting for them to finish
+downloads_cancelled = threading.Event()
+
+CHUNK_SIZE = 1 << 20  # 1 MiB chunks for downloads, compression workers and copies
+SPOOL_THRESHOLD = 64 << 20  # members above 64 MiB are compressed to a temp file
+# Fastest DEFLATE level: the archive is unpacked right away, so wall time matters more than ratio
+DEFAULT_COMPRESSLEVEL = 1
+DATA_DESCRIPTOR_FLAG = 0x08  # zip general purpose bit 3: CRC and sizes follow the data
+LZMA_EOS_FLAG = 0x02  # zip general purpose bit 1 for LZMA: stream ends with an EOS marker
+ZSTD_LEVEL = 3  # zstd's default; fast enough to keep up with the downloads
+RANGE_PARTS = 8  # parts one large file is split into; they share the connection limit
+RANGED_DOWNLOAD_THRESHOLD = 64 << 20  # smaller files are not worth splitting
+MAX_PARALLEL_DOWNLOADS = 8  # connections at once; keep well below per-IP limits of figshare/OSF
+MAX_QUEUED_DATASETS = 2  # datasets queued behind the running downloads
+# Stored as-is instead of compressed again (covers .nii.gz, .tsv.gz, ...)
+ALREADY_COMPRESSED_EXTENSIONS = (
+    '.gz', '.zst', '.xz', '.bz2', '.zip', '.png', '.jpg', '.jpeg', '.webp', '.mp4'
+)
+OPENNEURO_BUCKET_URL = 'https://s3.amazonaws.com/openneuro.org'
+# Downloaded whatever the includes are, as openneuro-py does, so the result stays a valid BIDS dataset
+BIDS_ESSENTIAL_FILES = frozenset({
+    'dataset_description.json', 'participants.tsv', 'participants.json', 'README', 'CHANGES', '.bidsignore'
+})
+S3_NAMESPACE = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+COMPRESSION_METHODS = {
+    'deflated': zipfile.ZIP_DEFLATED,
+    'stored': zipfile.ZIP_STORED,
+    'lzma': zipfile.ZIP_LZMA,
+}
 
 def load_datasets():
+    # Parse and split the list columns column-wise, then group rows by dataset name
+    table = pd.read_csv('static/datasets.csv', dtype=str, keep_default_na=False)
+    if 'code' not in table:
+        table['code'] = ''
+    table['files'] = table['files'].str.split('; ')
+    table['include_files'] = table['include_files'].str.split('; ')
+    table['folder_name'] = table['name'] + '_' + table['sub-dataset name'].str.replace(' ', '_')
+    table = table.rename(columns={'sub-dataset name': 'sub_dataset_name'})
+
+    columns = ['sub_dataset_name', 'description', 'files', 'download_url', 'size', 'folder_name', 'include_files', 'code']
     datasets = {}
-    with open('static/datasets.csv', mode='r') as file:
-        csv_reader = csv.DictReader(file)
-        for row in csv_reader:
-            name = row['name']
-            sub_dataset_name = row['sub-dataset name']
-            description = row['description']
-            files = row['files'].split('; ')
-            download_url = row['download_url']
-            size = row['size']
-            include_files = row['include_files'].split('; ')
-            code = row.get('code', '')  # Fetch the code, if present
-
-            if name not in datasets:
-                datasets[name] = []
-
-            datasets[name].append({
-                'sub_dataset_name': sub_dataset_name,
-                'description': description,
-                'files': files,
-                'download_url': download_url,
-                'size': size,
-                'folder_name': f"{name}_{sub_dataset_name.replace(' ', '_')}",
-                'include_files': include_files,
-                'code': code
-            })
+    for name, row in zip(table['name'], table[columns].to_dict('records')):
+        datasets.setdefault(name, []).append(row)
     return datasets
 
 def load_descriptions():
-    descriptions = {}
-    with open('static/dataset_descriptions.csv', mode='r') as file:
-        csv_reader = csv.DictReader(file)
-        for row in csv_reader:
-            name = row['name']
-            name_description = row['name_description']
-            descriptions[name] = name_description
-    return descriptions
-
-def extract_and_rename_zip(zip_path, extract_to, new_folder_name):
-    try:
-        temp_extract_to = os.path.join(extract_to, 'temp_extract')
-        os.makedirs(temp_extract_to, exist_ok=True)
-
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_extract_to)
-
-        top_level_dir = os.listdir(temp_extract_to)[0]
-        original_top_level_dir = os.path.join(temp_extract_to, top_level_dir)
-        new_path = os.path.join(extract_to, new_folder_name)
-        
-        shutil.move(original_top_level_dir, new_path)
-        shutil.rmtree(temp_extract_to)
-
-    except zipfile.BadZipFile as e:
-        print(f"Error extracting {zip_path}: {e}")
-    except FileNotFoundError as e:
-        print(f"File not found: {e}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-def zip_all_folders(source_dir, output_zip):
-    try:
-        if not os.path.exists(source_dir) or not os.listdir(source_dir):
-            raise Exception("Source directory does not exist or is empty.")
-
-        print(f"Zipping contents of {source_dir} into {output_zip}")  # Debug print
-
-        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for foldername, subfolders, filenames in os.walk(source_dir):
-                print(f"Processing folder: {foldername}")  # Debug: Show folder being processed
-                for filename in filenames:
-                    file_path = os.path.join(foldername, filename)
-                    arcname = os.path.relpath(file_path, source_dir)
-                    zipf.write(file_path, arcname)
-                    print(f"Added file: {file_path}")  # Debug: Show each file added
-
-        print(f"Successfully created {output_zip}. Size: {os.path.getsize(output_zip)} bytes")
-
-    except Exception as e:
-        print(f"Error creating zip file: {e}")
-        raise
-
-def download_file(url, output_path):
-    try:
-        response = requests.get(url, stream=True)
+    table = pd.read_csv('static/dataset_descriptions.csv', dtype=str, keep_default_na=False)
+    return dict(zip(table['name'], table['name_description']))
+
+def check_cancelled():
+    if downloads_cancelled.is_set():
+        raise Exception("Download cancelled")
+
+def read_chunk(stream, size=CHUNK_SIZE):
+    check_cancelled()
+    return stream.read(size)
+
+def connection_slot(connections):
+    # connections is a semaphore shared by every request of the run, so dataset downloads,
+    # file ranges and OpenNeuro objects together stay below the connection limit. Held only
+    # around a single request, never while waiting for other downloads.
+    return connections if connections is not None else nullcontext()
+
+def download_range(url, output_path, start, end, connections=None):
+    # Fetch bytes start..end (inclusive) into the same place of the preallocated file.
+    # Returns False if the server ignored the Range header.
+    headers = {'Range': f'bytes={start}-{end}', 'Accept-Encoding': 'identity'}
+    with connection_slot(connections), requests.get(url, headers=headers, stream=True) as response:
         response.raise_for_status()
-        with open(output_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
+        if response.status_code != 206:
+            return False
+        with open(output_path, 'r+b') as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = read_chunk(response.raw, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise requests.RequestException(f"Connection closed early for bytes {start}-{end} of {url}")
                 file.write(chunk)
+                remaining -= len(chunk)
+    return True
+
+def ranged_size(response):
+    # Total size from the Content-Range of a 206 answer, None if the server did not give
+    # one (e.g. 'bytes 0-0/*')
+    if response.status_code != 206:
+        return None
+    match = re.fullmatch(r'bytes \d+-\d+/(\d+)', response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+def download_ranges(url, output_path, size, connections=None):
+    # Split large files into RANGE_PARTS ranges fetched over separate connections, which
+    # gets around per-connection throughput limits. Returns False if a range was answered
+    # with the whole file, so the caller can fall back to a single stream.
+    with open(output_path, 'wb') as file:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(file.fileno(), 0, size)
+        else:
+            file.truncate(size)
+    part_size = -(-size // RANGE_PARTS)
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    with ThreadPoolExecutor(max_workers=RANGE_PARTS) as executor:
+        return all(executor.map(lambda r: download_range(url, output_path, *r, connections), ranges))
+
+def save_response(response, output_path):
+    # Copy the raw stream in 1 MiB blocks rather than iterating 8 KiB chunks in Python
+    response.raw.decode_content = True
+    with open(output_path, 'wb') as file:
+        for chunk in iter(partial(read_chunk, response.raw), b''):
+            file.write(chunk)
+
+def download_file(url, output_path, size=None, connections=None):
+    # size, if the caller knows it, saves probing files too small to split
+    check_cancelled()
+    try:
+        if size is None or size >= RANGED_DOWNLOAD_THRESHOLD:
+            # Probe with a one-byte GET instead of HEAD: presigned redirect targets (figshare)
+            # are only signed for GET
+            with connection_slot(connections), \
+                    requests.get(url, headers={'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'},
+                                 stream=True) as probe:
+                probe.raise_for_status()
+                if probe.status_code == 200:
+                    # No range support, the answer is the whole file
+                    save_response(probe, output_path)
+                    return
+                size = ranged_size(probe)
+            # Ranges go to the redirect target, so figshare only has to redirect once
+            url = probe.url
+            if size is not None and size >= RANGED_DOWNLOAD_THRESHOLD and \
+                    download_ranges(url, output_path, size, connections):
+                return
+        with connection_slot(connections), requests.get(url, stream=True) as response:
+            response.raise_for_status()
+            save_response(response, output_path)
     except requests.RequestException as e:
         print(f"Error downloading file from {url}: {e}")
         raise
@@ -111,41 +202,81 @@ def get_filename_from_response(response):
                 return filename
     return None
 
-def download_dataset_openneuro(dataset_id, include_files, download_path):
+def list_openneuro_files(dataset_id, connections=None):
+    # Yield (path relative to the dataset root, size) of all files in OpenNeuro's public
+    # S3 bucket for dataset_id, following ListObjectsV2 pagination
+    prefix = f"{dataset_id}/"
+    params = {'list-type': '2', 'prefix': prefix}
+    while True:
+        with connection_slot(connections):
+            response = requests.get(OPENNEURO_BUCKET_URL, params=params)
+        response.raise_for_status()
+        listing = ElementTree.fromstring(response.content)
+        for entry in listing.iterfind('s3:Contents', S3_NAMESPACE):
+            key = entry.findtext('s3:Key', '', S3_NAMESPACE)
+            if not key.endswith('/'):
+                yield key[len(prefix):], int(entry.findtext('s3:Size', '0', S3_NAMESPACE))
+        token = listing.findtext('s3:NextContinuationToken', None, S3_NAMESPACE)
+        if listing.findtext('s3:IsTruncated', 'false', S3_NAMESPACE) != 'true' or not token:
+            return
+        params['continuation-token'] = token
+
+def compile_include_patterns(include_files):
+    # One regex for all --include globs, so each S3 key is matched once instead of once
+    # per pattern and parent folder. Same rule as openneuro-py: a pattern matches a file
+    # or any folder above it ('*' in fnmatch also crosses '/', so 'pattern/*' covers
+    # everything below a matching folder).
+    if not include_files:
+        return None
+    globs = [glob for pattern in include_files for glob in (pattern, pattern.rstrip('/') + '/*')]
+    return re.compile('|'.join(fnmatch.translate(glob) for glob in globs))
+
+def download_dataset_openneuro(dataset_id, include_files, download_path, connections=None,
+                               max_workers=MAX_PARALLEL_DOWNLOADS):
+    # Fetch the files straight from OpenNeuro's S3 mirror in this process, instead of
+    # starting an openneuro-py interpreter per dataset, max_workers files at a time.
+    # Returns (local path, path in the dataset) for every downloaded file.
     try:
         os.makedirs(download_path, exist_ok=True)
-        command = ['openneuro-py', 'download', f'--dataset={dataset_id}', f'--target-dir={download_path}']
-        if include_files:
-            for include_file in include_files:
-                command.append(f'--include={include_file}')
-        
-        print(f"Running command: {' '.join(command)}")  # Debug: Print the command
-        result = subprocess.run(command, capture_output=True, text=True)
-        
-        # Check if the download command was successful
-        if result.returncode != 0:
-            print(f"Error downloading dataset {dataset_id}: {result.stderr}")
-            raise Exception(f"Download failed: {result.stderr}")
-
-        # Check if the directory is empty
-        if not os.listdir(download_path):
+        include = compile_include_patterns([pattern for pattern in include_files or [] if pattern])
+
+        def wanted(path):
+            if path in BIDS_ESSENTIAL_FILES:
+                return True
+            if include is None:
+                # Unfiltered downloads leave out dotfiles (e.g. .git, .datalad)
+                return not any(part.startswith('.') for part in path.split('/'))
+            return include.match(path) is not None
+
+        objects = [(path, size) for path, size in list_openneuro_files(dataset_id, connections) if wanted(path)]
+        if not objects:
             raise Exception("Download directory is empty. No files were downloaded.")
-        
+
+        def download(path, size):
+            target = os.path.join(download_path, *path.split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            download_file(f"{OPENNEURO_BUCKET_URL}/{dataset_id}/{quote(path)}", target, size, connections)
+            return target, path
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            files = list(executor.map(lambda obj: download(*obj), objects))
+
         print(f"Successfully downloaded dataset {dataset_id} to {download_path}")
-    
+        return files
+
     except Exception as e:
         print(f"Error during download: {e}")
         raise
 
-def create_readme(selected_urls, datasets, descriptions, readme_path):
-    with open(readme_path, 'w') as f:
+def index_datasets_by_url(datasets):
+    # download_url -> (dataset name, sub-dataset info), so lookups don't scan all datasets
+    return {item['download_url']: (name, item) for name, items in datasets.items() for item in items}
+
+def create_readme(selected_urls, datasets_by_url, descriptions, archive):
+    with io.StringIO() as f:
         for url in selected_urls:
-            dataset_info = next(
-                (item for items in datasets.values() for item in items if item['download_url'] == url),
-                None
-            )
-            if dataset_info:
-                name = next((k for k, v in datasets.items() if dataset_info in v), None)
+            if url in datasets_by_url:
+                name, dataset_info = datasets_by_url[url]
                 if name:
                     f.write(f"Dataset: {name}\n")
                     f.write(f"Sub-Dataset: {dataset_info['sub_dataset_name']}\n")
@@ -154,23 +285,470 @@ def create_readme(selected_urls, datasets, descriptions, readme_path):
                     f.write(f"Download URL: {url}\n")
                     f.write(f"Files: {', '.join(dataset_info['files'])}\n")
                     f.write(f"Code: {dataset_info['code']}\n\n")
+        readme = f.getvalue().encode('utf-8')
+
+    if isinstance(archive, tarfile.TarFile):
+        tarinfo = tarfile.TarInfo('README.txt')
+        tarinfo.size = len(readme)
+        tarinfo.mtime = time.time()
+        archive.addfile(tarinfo, io.BytesIO(readme))
+    else:
+        archive.writestr('README.txt', readme)
+
+def deflate_compressor(compresslevel):
+    # Raw DEFLATE stream as stored in zip members. ISA-L only has levels 0-3, so higher
+    # levels keep zlib rather than quietly compressing less.
+    if isal_zlib is not None and compresslevel <= isal_zlib.ISAL_BEST_COMPRESSION:
+        return isal_zlib.compressobj(compresslevel, isal_zlib.DEFLATED, -15)
+    return zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+
+def compress_file(file_path, arcname, spool_dir, compresslevel=DEFAULT_COMPRESSLEVEL, compress_type=zipfile.ZIP_DEFLATED):
+    # Runs in a worker process: produce the raw DEFLATE stream and CRC of one file.
+    # Stored members only need the CRC; their data is copied from file_path later.
+    # The file is memory-mapped so chunks are fed to crc32/DEFLATE without a read() copy.
+    crc = 0
+    compressor = deflate_compressor(compresslevel) if compress_type == zipfile.ZIP_DEFLATED else None
+    chunks = []
+    spool = None
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                for offset in range(0, size, CHUNK_SIZE):
+                    with view[offset:offset + CHUNK_SIZE] as chunk:
+                        crc = crc32(chunk, crc)
+                        if compressor is None:
+                            continue
+                        chunks.append(compressor.compress(chunk))
+                    # Spill large members to disk so many big files in flight don't exhaust memory
+                    if spool is None and offset > SPOOL_THRESHOLD:
+                        spool = tempfile.NamedTemporaryFile(dir=spool_dir, delete=False)
+                    if spool is not None:
+                        spool.write(b''.join(chunks))
+                        chunks = []
+        if compressor is not None and hasattr(os, 'posix_fadvise'):
+            # The source is not read again, keep it from crowding other data out of the page cache
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    if compressor is None:
+        return arcname, crc, None, size, size, compress_type
+    chunks.append(compressor.flush())
+    if spool is None:
+        data = b''.join(chunks)
+        return arcname, crc, data, size, len(data), compress_type
+    spool.write(b''.join(chunks))
+    compressed_size = spool.tell()
+    spool.close()
+    return arcname, crc, spool.name, size, compressed_size, compress_type
+
+def copy_bytes(source, target, count):
+    # Copy count bytes from the current position of source to that of target. Between
+    # regular files this happens in the kernel (copy_file_range, then sendfile), so the
+    # data never passes through Python; anything else falls back to a read/write loop.
+    target.flush()
+    source_offset = source.tell()
+    target_offset = target.tell()
+    copied = 0
+    try:
+        source_fd = source.fileno()
+        target_fd = target.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        source_fd = target_fd = None
 
-def zip_all_folders(source_dir, output_zip):
-    with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for foldername, subfolders, filenames in os.walk(source_dir):
-            for filename in filenames:
-                file_path = os.path.join(foldername, filename)
-                arcname = os.path.relpath(file_path, source_dir)
-                zipf.write(file_path, arcname)
+    if source_fd is not None and hasattr(os, 'copy_file_range'):
+        try:
+            while copied < count:
+                n = os.copy_file_range(source_fd, target_fd, count - copied,
+                                       source_offset + copied, target_offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass  # e.g. cross-device copy on older kernels
+    if source_fd is not None and copied < count and hasattr(os, 'sendfile'):
+        try:
+            os.lseek(target_fd, target_offset + copied, os.SEEK_SET)
+            while copied < count:
+                n = os.sendfile(target_fd, source_fd, source_offset + copied, count - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass  # e.g. macOS only sends to sockets
+
+    source.seek(source_offset + copied)
+    target.seek(target_offset + copied)
+    while copied < count:
+        chunk = source.read(min(CHUNK_SIZE, count - copied))
+        if not chunk:
+            raise EOFError("Unexpected end of data while copying")
+        target.write(chunk)
+        copied += len(chunk)
+
+def write_raw_member(zipf, zinfo, data=None, fileobj=None):
+    # Append a member whose data is already in its final (compressed) form:
+    # local header, then the raw bytes from `data` or compress_size bytes of `fileobj`
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    with zipf._lock:
+        zipf.fp.seek(zipf.start_dir)
+        zinfo.header_offset = zipf.fp.tell()
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        if data is not None:
+            zipf.fp.write(data)
+        else:
+            copy_bytes(fileobj, zipf.fp, zinfo.compress_size)
+        if zinfo.flag_bits & DATA_DESCRIPTOR_FLAG:
+            fmt = '<4sLQQ' if zip64 else '<4sLLL'
+            zipf.fp.write(struct.pack(fmt, b'PK\x07\x08', zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        zipf.start_dir = zipf.fp.tell()
+
+def write_precompressed(zipf, file_path, arcname, crc, data, size, compressed_size, compress_type=zipfile.ZIP_DEFLATED):
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    zinfo.compress_type = compress_type
+    if compress_type == zipfile.ZIP_LZMA:
+        zinfo.flag_bits |= LZMA_EOS_FLAG
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = compressed_size
+    if isinstance(data, bytes):
+        write_raw_member(zipf, zinfo, data=data)
+    elif data is None:
+        # Stored member: the source file is the member data
+        with open(file_path, 'rb') as source:
+            write_raw_member(zipf, zinfo, fileobj=source)
+    else:
+        with open(data, 'rb') as spool:
+            write_raw_member(zipf, zinfo, fileobj=spool)
+        os.remove(data)
+
+def iter_files(folder, arc_prefix=''):
+    # Like os.walk, but reuses the file type cached by scandir instead of a stat per entry
+    # and builds arcnames by concatenation
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path, arc_prefix + entry.name + '/')
+            elif entry.is_file():
+                yield entry.path, arc_prefix + entry.name
+
+def member_compression(filename, compression):
+    # Data that is already compressed gains next to nothing from another DEFLATE pass
+    if filename.lower().endswith(ALREADY_COMPRESSED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return compression
+
+def write_symlink(zipf, arcname, target_arcname):
+    # A unix symlink entry pointing at another member; unzip and most archive tools
+    # restore it as a link
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+    zinfo.create_system = 3  # unix, so external_attr carries st_mode
+    zinfo.external_attr = (stat.S_IFLNK | 0o777) << 16
+    zipf.writestr(zinfo, posixpath.relpath(target_arcname, posixpath.dirname(arcname)))
+
+def stream_digest(stream):
+    hasher = hashlib.blake2b(digest_size=32)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return hasher.digest()
+        hasher.update(chunk)
+
+def file_digest(file_path):
+    with open(file_path, 'rb') as f:
+        return stream_digest(f)
+
+def member_digest(zip_ref, name):
+    with zip_ref.open(name) as member:
+        return stream_digest(member)
+
+def file_crc(file_path):
+    crc = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return crc
+            crc = crc32(chunk, crc)
+
+def link_duplicate(zipf, seen_members, arcname, crc, size, digest):
+    # Deduplication: seen_members maps (CRC, size) to [arcname, content digest] pairs of the
+    # members added so far. If an earlier member has the same content, write arcname as a
+    # symlink to it and return True; otherwise record arcname and return False.
+    # digest is a callable, only run when CRC and size already match a member. Digests of
+    # those earlier members are read back from the archive, as their source may be gone.
+    if seen_members is None or not size:
+        return False  # empty files are not worth a link
+    candidates = seen_members.setdefault((crc, size), [])
+    if not candidates:
+        candidates.append([arcname, None])
+        return False
+    new_digest = digest()
+    for candidate in candidates:
+        if candidate[1] is None:
+            candidate[1] = member_digest(zipf, candidate[0])
+        if candidate[1] == new_digest:
+            write_symlink(zipf, arcname, candidate[0])
+            logger.debug("Linked duplicate %s to %s", arcname, candidate[0])
+            return True
+    candidates.append([arcname, new_digest])
+    return False
+
+def add_folder_to_zip(zipf, source_dir, prefix='', seen_members=None):
+    jobs = list(iter_files(source_dir, prefix + '/' if prefix else ''))
+    add_files_to_zip(zipf, jobs, prefix or source_dir, seen_members)
+
+def add_files_to_zip(zipf, jobs, desc, seen_members=None):
+    # jobs are (file path, arcname) pairs; seen_members turns on deduplication (see link_duplicate)
+    if zipf.compression not in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+        # LZMA/BZIP2 have no precompressed path
+        for file_path, arcname in tqdm(jobs, desc=desc, unit='file', disable=None):
+            if seen_members is not None and link_duplicate(
+                    zipf, seen_members, arcname, file_crc(file_path), os.path.getsize(file_path),
+                    partial(file_digest, file_path)):
+                continue
+            zipf.write(file_path, arcname, compress_type=member_compression(arcname, zipf.compression))
+            logger.debug("Added file: %s", file_path)
+        return
+
+    def write_result(file_path, result):
+        arcname, crc, data, size = result[:4]
+        if link_duplicate(zipf, seen_members, arcname, crc, size, partial(file_digest, file_path)):
+            if isinstance(data, str):
+                os.remove(data)
+            return
+        write_precompressed(zipf, file_path, *result)
+        logger.debug("Added file: %s", file_path)
+
+    compresslevel = zipf.compresslevel if zipf.compresslevel is not None else DEFAULT_COMPRESSLEVEL
+    spool_parent = os.path.dirname(os.path.abspath(zipf.filename))
+    max_workers = os.cpu_count() or 1
+    # Download threads are still running, and forking a multithreaded process can deadlock
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with tempfile.TemporaryDirectory(dir=spool_parent) as spool_dir, \
+            ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method)) as executor, \
+            tqdm(total=len(jobs), desc=desc, unit='file', disable=None) as progress:
+        # Keep a bounded window of submitted jobs and write results in walk order
+        pending = deque()
+        for file_path, arcname in jobs:
+            pending.append((file_path, executor.submit(
+                compress_file, file_path, arcname, spool_dir, compresslevel,
+                member_compression(arcname, zipf.compression)
+            )))
+            if len(pending) >= 2 * max_workers:
+                done_path, future = pending.popleft()
+                write_result(done_path, future.result())
+                progress.update()
+        while pending:
+            done_path, future = pending.popleft()
+            write_result(done_path, future.result())
+            progress.update()
+
+def zip_all_folders(source_dir, output_zip, compression=zipfile.ZIP_DEFLATED, compresslevel=DEFAULT_COMPRESSLEVEL):
+    with zipfile.ZipFile(output_zip, 'w', compression, compresslevel=compresslevel) as zipf:
+        add_folder_to_zip(zipf, source_dir)
     print(f"Successfully created {output_zip}.")
 
+def download_compressed(url, spool_path, compress_type, compresslevel, with_digest=False, connections=None):
+    # Runs in a download thread: compress the response body while it arrives, so the
+    # zip writer only has to copy the finished member into the archive. with_digest adds
+    # a content digest of the body for deduplication (None otherwise).
+    try:
+        with connection_slot(connections), requests.get(url, stream=True) as response:
+            response.raise_for_status()
+            filename = get_filename_from_response(response)
+            if filename is None:
+                filename = url.split('/')[-1]
+            compress_type = member_compression(filename, compress_type)
+            response.raw.decode_content = True
+            if compress_type == zipfile.ZIP_DEFLATED:
+                compressor = deflate_compressor(compresslevel)
+            else:
+                compressor = zipfile._get_compressor(compress_type, compresslevel)
+            crc = 0
+            size = 0
+            hasher = hashlib.blake2b(digest_size=32) if with_digest else None
+            with open(spool_path, 'wb') as out:
+                while True:
+                    chunk = read_chunk(response.raw)
+                    if not chunk:
+                        break
+                    crc = crc32(chunk, crc)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    size += len(chunk)
+                    out.write(compressor.compress(chunk) if compressor else chunk)
+                if compressor:
+                    out.write(compressor.flush())
+                compressed_size = out.tell()
+        digest = hasher.digest() if hasher is not None else None
+        return filename, crc, size, compressed_size, compress_type, digest
+    except requests.RequestException as e:
+        print(f"Error downloading file from {url}: {e}")
+        raise
+
+def renamed_members(zip_ref, new_folder_name):
+    # Yield (info, new name) for the files of a downloaded zip, with its top-level folder
+    # renamed to new_folder_name. Only strip the top-level folder if everything lives in
+    # it; zips with several top-level entries are nested under new_folder_name as they are.
+    names = zip_ref.namelist()
+    if not names:
+        raise zipfile.BadZipFile(f"{zip_ref.filename} is empty")
+    top_level_entries = {name.split('/')[0] for name in names}
+    if len(top_level_entries) == 1 and all('/' in name for name in names):
+        strip = len(top_level_entries.pop()) + 1
+    else:
+        strip = 0
+    for info in zip_ref.infolist():
+        if not info.is_dir():
+            yield info, f"{new_folder_name}/{info.filename[strip:]}"
+
+def transplant_zip(zip_path, zipf, new_folder_name, seen_members=None):
+    # Move the members of a downloaded zip into the archive without recompressing them,
+    # renaming the top-level folder in the same pass. One handle serves both the central
+    # directory and the raw member reads.
+    with open(zip_path, 'rb') as raw, zipfile.ZipFile(raw, 'r') as zip_ref:
+        for info, arcname in renamed_members(zip_ref, new_folder_name):
+            if link_duplicate(zipf, seen_members, arcname, info.CRC, info.file_size,
+                              partial(member_digest, zip_ref, info)):
+                continue
+            zinfo = zipfile.ZipInfo(arcname, info.date_time)
+            zinfo.compress_type = info.compress_type
+            zinfo.flag_bits = info.flag_bits
+            zinfo.CRC = info.CRC
+            zinfo.file_size = info.file_size
+            zinfo.compress_size = info.compress_size
+            zinfo.external_attr = info.external_attr
+            zinfo.create_system = info.create_system
+
+            # Skip the source local header to get to the compressed bytes
+            raw.seek(info.header_offset)
+            header = raw.read(zipfile.sizeFileHeader)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            raw.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+            write_raw_member(zipf, zinfo, fileobj=raw)
+
+def add_zip_to_tar(zip_path, tar, new_folder_name):
+    # Tar members have no compression of their own, so zip members are decompressed here
+    # and compressed again by the single zstd stream around the tar
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for info, arcname in renamed_members(zip_ref, new_folder_name):
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.size = info.file_size
+            tarinfo.mtime = time.mktime(info.date_time + (0, 0, -1))
+            tarinfo.mode = (info.external_attr >> 16) & 0o777 or 0o644
+            with zip_ref.open(info) as member:
+                tar.addfile(tarinfo, member)
+
+@contextmanager
+def open_tar_zst(path):
+    # A single multithreaded zstd stream around a streamed tar: no per-member framing
+    # and compression spread over all cores
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+    with open(path, 'wb') as file, \
+            compressor.stream_writer(file, closefd=False) as zstd_stream, \
+            tarfile.open(fileobj=zstd_stream, mode='w|') as tar:
+        yield tar
+
+def open_archive(path, archive_format, compression, compresslevel):
+    if archive_format == 'tar.zst':
+        return open_tar_zst(path)
+    return zipfile.ZipFile(path, 'w', compression, compresslevel=compresslevel)
+
+def fetch_dataset(url, folder_name, include_files, staging_dir, archive_format, compress_type, compresslevel,
+                  seen_members=None, connections=None, max_downloads=MAX_PARALLEL_DOWNLOADS):
+    # Runs in a download thread. Returns the staged path and a callable that adds it to
+    # the final archive; only the main thread writes to the archive.
+    if 'figshare' in url:
+        zip_path = os.path.join(staging_dir, folder_name + '.zip')
+        print(f"Downloading {folder_name} from {url}...")
+        try:
+            download_file(url, zip_path, connections=connections)
+        except Exception as e:
+            print(f"Error downloading {folder_name}: {e}")
+            return zip_path, None
+        if archive_format == 'tar.zst':
+            return zip_path, partial(add_zip_to_tar, zip_path, new_folder_name=folder_name)
+        return zip_path, partial(transplant_zip, zip_path, new_folder_name=folder_name, seen_members=seen_members)
+
+    elif 'osf' in url:
+        spool_path = os.path.join(staging_dir, folder_name + '.part')
+        print(f"Downloading {folder_name} from {url}...")
+        try:
+            filename, crc, size, compressed_size, member_type, digest = download_compressed(
+                url, spool_path, compress_type, compresslevel, seen_members is not None, connections
+            )
+        except Exception as e:
+            print(f"Error downloading {folder_name}: {e}")
+            return spool_path, None
+        if archive_format == 'tar.zst':
+            return spool_path, lambda tar: tar.add(spool_path, arcname=f"{folder_name}/{filename}")
+
+        def add_download(zipf):
+            arcname = f"{folder_name}/{filename}"
+            if not link_duplicate(zipf, seen_members, arcname, crc, size, lambda: digest):
+                write_precompressed(zipf, spool_path, arcname, crc, spool_path, size, compressed_size, member_type)
+
+        return spool_path, add_download
+
+    elif 'openneuro' in url:
+        dataset_id = url.split('/')[-1]
+        target_folder = os.path.join(staging_dir, folder_name)
+        print(f"Downloading OpenNeuro dataset {dataset_id} into {target_folder}...")
+        try:
+            files = download_dataset_openneuro(dataset_id, include_files, target_folder, connections, max_downloads)
+        except Exception as e:
+            print(f"Error downloading OpenNeuro dataset: {e}")
+            return target_folder, None
+        if archive_format == 'tar.zst':
+            return target_folder, lambda tar: tar.add(target_folder, arcname=folder_name)
+        # The downloaded files are zipped where they are, without walking the folder again
+        jobs = [(file_path, f"{folder_name}/{path}") for file_path, path in files]
+        return target_folder, partial(add_files_to_zip, jobs=jobs, desc=folder_name, seen_members=seen_members)
+
+    return None, None
+
 def main():
     parser = argparse.ArgumentParser(description='Download and package THINGS datasets.')
     parser.add_argument('output_dir', type=str, help='Directory to store the final zip folder and temporary files.')
+    parser.add_argument('--format', choices=['zip', 'tar.zst'], default='zip',
+                        help='Archive format (default: zip). tar.zst uses multithreaded zstd and '
+                             'needs the zstandard package.')
+    parser.add_argument('--compression', choices=COMPRESSION_METHODS, default='deflated',
+                        help='Compression method for the final zip folder (default: deflated). '
+                             'Already compressed files are always stored.')
+    parser.add_argument('--compresslevel', type=int, default=DEFAULT_COMPRESSLEVEL,
+                        help=f'DEFLATE compression level from 1 to 9 (default: {DEFAULT_COMPRESSLEVEL}, fastest). '
+                             'Use --compression stored for no compression.')
+    parser.add_argument('--max-downloads', type=int, default=MAX_PARALLEL_DOWNLOADS,
+                        help=f'Number of datasets downloaded at the same time, and of connections they share '
+                             f'with their file ranges and OpenNeuro files (default: {MAX_PARALLEL_DOWNLOADS}). '
+                             f'Up to this many plus {MAX_QUEUED_DATASETS} datasets are staged in output_dir at once; '
+                             'lower it if the drive is short on space.')
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='Store files with identical content once and add later copies as symlinks '
+                             '(zip format only).')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every file added to the zip folder.')
     args = parser.parse_args()
+    if not 1 <= args.compresslevel <= 9:
+        parser.error('--compresslevel must be between 1 and 9')
+    if args.max_downloads < 1:
+        parser.error('--max-downloads must be at least 1')
+    if args.format == 'tar.zst' and zstandard is None:
+        parser.error('--format tar.zst needs the zstandard package (pip install zstandard)')
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    if args.verbose:
+        # Only this module's messages; urllib3 logs every connection at DEBUG
+        logger.setLevel(logging.DEBUG)
 
     output_dir = args.output_dir
     datasets = load_datasets()
+    datasets_by_url = index_datasets_by_url(datasets)
     descriptions = load_descriptions()
 
     print("Available Datasets:\n")
@@ -187,80 +765,91 @@ def main():
 
     selected_urls = []
     folder_names = []
+    # The numbers shown above, mapped to their sub-datasets once
+    numbered = {
+        (idx, sub_idx): sub
+        for idx, info in enumerate(datasets.values(), start=1)
+        for sub_idx, sub in enumerate(info, start=1)
+    }
     for sel in selection:
         try:
             main_idx, sub_idx = map(int, sel.split('.'))
-            main_key = list(datasets.keys())[main_idx - 1]
-            sub_dataset = datasets[main_key][sub_idx - 1]
+            sub_dataset = numbered[(main_idx, sub_idx)]
+            if sub_dataset['download_url'] in selected_urls:
+                # Picked twice; a second download would share the staging path of the first
+                continue
             selected_urls.append(sub_dataset['download_url'])
             folder_name = sub_dataset['folder_name']
             folder_names.append(folder_name)
-        except (ValueError, IndexError):
+        except (ValueError, KeyError):
             print(f"Invalid selection: {sel}. Skipping.")
 
     if not selected_urls:
         print("No valid datasets selected. Exiting.")
         return
 
-    download_dir = os.path.join(output_dir, 'downloads')
-    extracted_dir = os.path.join(output_dir, 'extracted')
-    os.makedirs(download_dir, exist_ok=True)
-    os.makedirs(extracted_dir, exist_ok=True)
-
-    extracted_folders = []
-
-    for url, folder_name in zip(selected_urls, folder_names):
-        files = next(
-            (item['files'] for items in datasets.values() for item in items if item['download_url'] == url),
-            None
-        )
-        include_files = next(
-            (item.get('include_files') for items in datasets.values() for item in items if item['download_url'] == url),
-            None
-        )
-
-        if 'figshare' in url:
-            zip_path = os.path.join(download_dir, folder_name + '.zip')
-            print(f"Downloading {zip_path} from {url}...")
-            download_file(url, zip_path)
-            print(f"Extracting {zip_path}...")
-            extract_and_rename_zip(zip_path, extracted_dir, folder_name)
-            extracted_folders.append(os.path.join(extracted_dir, folder_name))
-
-        elif 'osf' in url:
-            folder_path = os.path.join(extracted_dir, folder_name)
-            os.makedirs(folder_path, exist_ok=True)
-            response = requests.get(url, stream=True)
-            response.raise_for_status()
-            filename = get_filename_from_response(response)
-            if filename is None:
-                filename = url.split('/')[-1]
-            file_path = os.path.join(folder_path, filename)
-            print(f"Downloading {file_path} from {url}...")
-            download_file(url, file_path)
-            extracted_folders.append(folder_path)
-
-        elif 'openneuro' in url:
-            dataset_id = url.split('/')[-1]
-            target_folder = os.path.join(extracted_dir, folder_name)
-            print(f"Downloading OpenNeuro dataset {dataset_id} into {target_folder}...")
-            try:
-                os.makedirs(target_folder, exist_ok=True)
-                download_dataset_openneuro(dataset_id, include_files, target_folder)
-                extracted_folders.append(target_folder)
-            except Exception as e:
-                print(f"Error downloading OpenNeuro dataset: {e}")
+    os.makedirs(output_dir, exist_ok=True)
+    archive_path = os.path.join(output_dir, f'things-datasets.{args.format}')
+    # Members of a tar.zst are compressed by the surrounding zstd stream only
+    compression = COMPRESSION_METHODS[args.compression] if args.format == 'zip' else zipfile.ZIP_STORED
 
-    readme_path = os.path.join(extracted_dir, 'README.txt')
-    create_readme(selected_urls, datasets, descriptions, readme_path)
+    # (CRC, size) -> [arcname, digest] of every member added so far, shared by all datasets
+    seen_members = {} if args.deduplicate and args.format == 'zip' else None
+    # One limit for all requests, however they are split across datasets and ranges
+    connections = threading.BoundedSemaphore(args.max_downloads)
 
-    main_zip_path = os.path.join(output_dir, 'things-datasets.zip')
-    zip_all_folders(extracted_dir, main_zip_path)
+    downloads = iter([
+        (url, folder_name, datasets_by_url[url][1].get('include_files'))
+        for url, folder_name in zip(selected_urls, folder_names)
+    ])
 
-    shutil.rmtree(download_dir)
-    shutil.rmtree(extracted_dir)
+    try:
+        with tempfile.TemporaryDirectory(dir=output_dir) as staging_dir, \
+                ThreadPoolExecutor(max_workers=args.max_downloads) as executor, \
+                open_archive(archive_path, args.format, compression, args.compresslevel) as archive:
+            def submit_next_download():
+                download = next(downloads, None)
+                if download is not None:
+                    pending.add(executor.submit(
+                        fetch_dataset, *download, staging_dir, args.format, compression, args.compresslevel,
+                        seen_members, connections, args.max_downloads
+                    ))
+
+            # Download and archive as a pipeline: max_downloads transfers run and MAX_QUEUED_DATASETS
+            # more wait in the pool, so a freed thread starts the next one while the main thread
+            # archives. Another dataset is only submitted once one has been archived, so at most
+            # max_downloads + MAX_QUEUED_DATASETS datasets (partial or finished) are staged on disk.
+            pending = set()
+            for _ in range(args.max_downloads + MAX_QUEUED_DATASETS):
+                submit_next_download()
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        staged_path, add_to_archive = future.result()
+                        if add_to_archive is not None:
+                            print(f"Adding {staged_path} to {archive_path}...")
+                            add_to_archive(archive)
+                        if staged_path is not None and os.path.isdir(staged_path):
+                            shutil.rmtree(staged_path)
+                        elif staged_path is not None and os.path.exists(staged_path):
+                            os.remove(staged_path)
+                        submit_next_download()
+            except BaseException:
+                # Don't start the queued downloads on the way out, and stop the running ones
+                downloads_cancelled.set()
+                for future in pending:
+                    future.cancel()
+                raise
+
+            create_readme(selected_urls, datasets_by_url, descriptions, archive)
+    except BaseException:
+        # An archive cut off halfway (e.g. a zip without central directory) is of no use
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        raise
 
-    print(f"All selected datasets are packaged into {main_zip_path}.")
+    print(f"All selected datasets are packaged into {archive_path}.")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file